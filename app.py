@@ -1,123 +1,269 @@
 import streamlit as st
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import box, Point, MultiPolygon
-import simplekml
-from io import BytesIO
+import numpy as np
+import shapely
+from shapely.geometry import Point
+from io import BytesIO, TextIOWrapper
+from xml.sax.saxutils import escape
+from pyproj import Transformer
+import pyogrio
 import math
 
+# Transformer PROJ dibuat sekali per proses (WGS84 <-> UTM 48S)
+UTM_EPSG = 32748
+TO_UTM = Transformer.from_crs(4326, UTM_EPSG, always_xy=True)
+TO_WGS = Transformer.from_crs(UTM_EPSG, 4326, always_xy=True)
+
+# Warna KML (aabbggrr) per status FAT
+KML_COLORS = {'green': 'ff008000', 'red': 'ff0000ff'}
+
+# Style FAT ditulis sekali di level Document, placemark cukup merujuk lewat styleUrl
+KML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+    + ''.join(
+        f'<Style id="fat-{status}"><LineStyle><color>{color}</color><width>2</width></LineStyle>'
+        f'<PolyStyle><color>{color}</color></PolyStyle></Style>\n'
+        for status, color in KML_COLORS.items()
+    )
+)
+KML_FOOTER = '</Document>\n</kml>\n'
+
 st.set_page_config(layout="wide")
 st.title("📍 Grid Identifikasi Homepass (Max 16 per Area 250m²)")
 
-def load_kml(uploaded_file):
+@st.cache_data(show_spinner=False)
+def load_kml(file_bytes):
+    """Baca titik HP dari isi file KML; di-cache per isi file agar rerun Streamlit tidak parse ulang"""
     try:
-        gdf = gpd.read_file(uploaded_file, driver='KML')
+        gdf = pyogrio.read_dataframe(BytesIO(file_bytes))
         return gdf[gdf.geometry.type == 'Point']
     except Exception as e:
         st.error(f"Gagal memuat KML: {str(e)}")
         return None
 
-def create_aligned_grids(gdf, grid_size=15.8):
-    bounds = gdf.total_bounds
-    minx, miny, maxx, maxy = bounds
+def grid_layout(gdf, grid_size=15.8):
+    """Titik awal serta jumlah kolom & baris grid yang menutupi semua titik"""
+    minx, miny, maxx, maxy = gdf.total_bounds
     
-    cols = math.ceil((maxx - minx) / grid_size)
-    rows = math.ceil((maxy - miny) / grid_size)
+    cols = max(math.ceil((maxx - minx) / grid_size), 1)
+    rows = max(math.ceil((maxy - miny) / grid_size), 1)
     
-    polygons = []
-    for i in range(cols):
-        for j in range(rows):
-            x = minx + i * grid_size
-            y = miny + j * grid_size
-            polygons.append(box(x, y, x + grid_size, y + grid_size))
+    return minx, miny, cols, rows
+
+def create_aligned_grids(gdf, cells, grid_size=15.8):
+    """Bangun polygon grid hanya untuk sel yang diminta (indeks kolom * rows + baris)"""
+    minx, miny, cols, rows = grid_layout(gdf, grid_size)
+    
+    # Semua sel dibangun sekaligus; index GeoDataFrame = indeks sel
+    col, row = np.divmod(cells, rows)
+    x = minx + col * grid_size
+    y = miny + row * grid_size
+    polygons = shapely.box(x, y, x + grid_size, y + grid_size)
     
-    return gpd.GeoDataFrame(geometry=polygons, crs=gdf.crs)
+    return gpd.GeoDataFrame(geometry=polygons, index=cells, crs=gdf.crs)
 
-def create_fat_areas(grid_with_hp, gdf):
-    """Hanya membuat FAT area untuk grid yang memiliki HP"""
-    fat_areas = []
-    homepass_groups = {}
-    fat_index = 1
+def locate_grid_cells(gdf, grid_size=15.8):
+    """Indeks sel grid tiap titik (kolom * rows + baris), sama dengan index create_aligned_grids"""
+    minx, miny, cols, rows = grid_layout(gdf, grid_size)
     
-    # Urutkan berdasarkan jumlah HP (descending)
-    grid_sorted = grid_with_hp.sort_values('homepass', ascending=False)
+    # Grid seragam & sejajar sumbu: sel cukup dihitung dengan pembagian integer
+    xy = shapely.get_coordinates(gdf.geometry.values)
+    col = np.clip(((xy[:, 0] - minx) // grid_size).astype(np.int64), 0, cols - 1)
+    row = np.clip(((xy[:, 1] - miny) // grid_size).astype(np.int64), 0, rows - 1)
     
-    for _, row in grid_sorted.iterrows():
-        if row['homepass'] == 0:
-            continue  # Skip grid tanpa HP
-            
-        if row['homepass'] >= 16:
+    return col * rows + row
+
+@st.cache_data(show_spinner=False)
+def build_grid(file_bytes, grid_size=15.8):
+    """Proyeksikan HP ke UTM lalu hitung HP per sel grid; di-cache per isi file & ukuran grid"""
+    gdf_wgs = load_kml(file_bytes)
+    
+    # Konversi ke UTM langsung pada array koordinat dengan transformer yang di-cache.
+    # gdf_wgs (koordinat asli) tetap disimpan untuk export, jadi tidak perlu reproyeksi balik
+    x, y = TO_UTM.transform(gdf_wgs.geometry.x.to_numpy(), gdf_wgs.geometry.y.to_numpy())
+    gdf = gpd.GeoDataFrame(
+        gdf_wgs.drop(columns='geometry'),
+        geometry=gpd.points_from_xy(x, y),
+        crs=UTM_EPSG
+    )
+    
+    # Hitung titik per sel tanpa spatial join, lalu bangun polygon hanya untuk sel yang berisi HP
+    gdf['cell'] = locate_grid_cells(gdf, grid_size)
+    cells, counts = np.unique(gdf['cell'], return_counts=True)
+    grid_with_hp = create_aligned_grids(gdf, cells, grid_size)
+    grid_with_hp['homepass'] = counts
+    
+    return gdf, grid_with_hp
+
+def pack_cells(homepass, max_hp=16):
+    """Kelompokkan sel (sudah terurut) ke FAT secara first-fit; kembalikan nomor FAT tiap sel"""
+    fat_of_cell = np.empty(len(homepass), dtype=np.int64)
+    fat_hp = []  # Total HP per FAT
+    open_fats = []  # FAT yang masih bisa menampung HP, dalam urutan pembuatan
+    
+    for k, hp in enumerate(homepass.tolist()):
+        if hp >= max_hp:
             # Grid dengan ≥16 HP menjadi FAT area sendiri
-            fat_areas.append({
-                'geometry': row['geometry'],
-                'homepass': row['homepass'],
-                'label': f'FAT {fat_index}',
-                'color': 'green'
-            })
-            
-            # Kelompokkan HP
-            points_in_grid = gdf[gdf.geometry.within(row['geometry'])]
-            homepass_groups[f'FAT {fat_index}'] = points_in_grid
-            fat_index += 1
+            fat_of_cell[k] = len(fat_hp)
+            fat_hp.append(hp)
+            continue
+        
+        # Cari FAT area terdekat yang masih bisa menampung
+        for i, fat in enumerate(open_fats):
+            if fat_hp[fat] + hp <= max_hp:
+                fat_hp[fat] += hp
+                if fat_hp[fat] >= max_hp:
+                    del open_fats[i]  # FAT penuh tidak perlu dicek lagi
+                break
         else:
-            # Cari FAT area terdekat yang masih bisa menampung
-            added = False
-            for fat in fat_areas:
-                if fat['homepass'] + row['homepass'] <= 16:
-                    # Gabungkan geometry
-                    fat['geometry'] = MultiPolygon([fat['geometry'], row['geometry']]).convex_hull
-                    fat['homepass'] += row['homepass']
-                    
-                    # Gabungkan HP
-                    points_in_grid = gdf[gdf.geometry.within(row['geometry'])]
-                    if fat['label'] in homepass_groups:
-                        homepass_groups[fat['label']] = pd.concat([homepass_groups[fat['label']], points_in_grid])
-                    else:
-                        homepass_groups[fat['label']] = points_in_grid
-                    
-                    added = True
-                    break
+            # Buat FAT area baru untuk grid ini
+            fat = len(fat_hp)
+            fat_hp.append(hp)
+            open_fats.append(fat)
+        
+        fat_of_cell[k] = fat
+    
+    return fat_of_cell
+
+def create_fat_areas(grid_with_hp, gdf):
+    """Hanya membuat FAT area untuk grid yang memiliki HP"""
+    # Urutkan berdasarkan jumlah HP (descending), lalu packing pada array biasa
+    grid_sorted = grid_with_hp.sort_values('homepass', ascending=False)
+    homepass = grid_sorted['homepass'].to_numpy()
+    fat_of_cell = pack_cells(homepass)
+    n_fats = fat_of_cell.max() + 1
+    
+    # Warna hijau hanya untuk FAT dari satu grid ≥16 HP, sisanya merah (<16 HP)
+    green = np.zeros(n_fats, dtype=bool)
+    green[fat_of_cell[homepass >= 16]] = True
+    
+    # Kumpulkan sel per FAT (sel diurutkan berdasarkan nomor FAT)
+    order = np.argsort(fat_of_cell, kind='stable')
+    cells_sorted = np.asarray(grid_sorted.geometry.values)[order]
+    fat_sorted = fat_of_cell[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(fat_sorted)) + 1]
+    
+    # Batas tiap FAT langsung dari batas selnya
+    cell_bounds = shapely.bounds(cells_sorted)
+    minx = np.minimum.reduceat(cell_bounds[:, 0], starts)
+    miny = np.minimum.reduceat(cell_bounds[:, 1], starts)
+    maxx = np.maximum.reduceat(cell_bounds[:, 2], starts)
+    maxy = np.maximum.reduceat(cell_bounds[:, 3], starts)
+    
+    # FAT yang selnya mengisi penuh persegi panjang batasnya cukup berupa box;
+    # convex hull hanya dihitung untuk FAT berbentuk L/T dan sejenisnya
+    cell_area = (cell_bounds[0, 2] - cell_bounds[0, 0]) * (cell_bounds[0, 3] - cell_bounds[0, 1])
+    n_cells = np.diff(np.r_[starts, len(fat_sorted)])
+    solid = np.isclose((maxx - minx) * (maxy - miny), n_cells * cell_area)
+    
+    hulls = shapely.box(minx, miny, maxx, maxy)
+    if not solid.all():
+        irregular = ~solid[fat_sorted]
+        _, indices = np.unique(fat_sorted[irregular], return_inverse=True)
+        hulls[~solid] = shapely.convex_hull(shapely.multipolygons(cells_sorted[irregular], indices=indices))
+    
+    labels = [f'FAT {i}' for i in range(1, n_fats + 1)]
+    fat_areas = gpd.GeoDataFrame({
+        'homepass': np.bincount(fat_of_cell, weights=homepass).astype(int),
+        'label': labels,
+        'color': np.where(green, 'green', 'red')
+    }, geometry=hulls, crs=grid_with_hp.crs)
+    
+    # Setiap HP langsung dipetakan ke FAT lewat selnya (index grid = indeks sel dari locate_grid_cells)
+    cell_to_fat = pd.Series(fat_of_cell, index=grid_sorted.index)
+    point_fat = cell_to_fat.loc[gdf['cell'].to_numpy()].to_numpy()
+    
+    # Posisi baris HP per FAT (urutan baris gdf sama dengan gdf_wgs): urutkan sekali, lalu potong per FAT
+    point_order = np.argsort(point_fat, kind='stable')
+    bounds = np.searchsorted(point_fat[point_order], np.arange(1, n_fats))
+    homepass_groups = dict(zip(labels, np.split(point_order, bounds)))
+    
+    return fat_areas, homepass_groups
+
+def kml_coords(coords):
+    """Format deretan koordinat (lon, lat) menjadi isi tag <coordinates>"""
+    return ' '.join(f'{x},{y},0' for x, y in coords)
+
+def kml_polygons(geoms):
+    """Elemen geometri KML untuk tiap (Multi)Polygon; koordinat semua ring diambil sekaligus"""
+    parts, owner = shapely.get_parts(geoms, return_index=True)
+    xy, ring = shapely.get_coordinates(shapely.get_exterior_ring(parts), return_index=True)
+    rings = np.split(xy, np.flatnonzero(np.diff(ring)) + 1)
+    
+    polygons = [[] for _ in range(len(geoms))]
+    for i, coords in zip(owner, rings):
+        polygons[i].append(
+            '<Polygon><outerBoundaryIs><LinearRing>'
+            f'<coordinates>{kml_coords(coords.tolist())}</coordinates>'
+            '</LinearRing></outerBoundaryIs></Polygon>'
+        )
+    
+    return [p[0] if len(p) == 1 else f'<MultiGeometry>{"".join(p)}</MultiGeometry>' for p in polygons]
+
+def write_kml(out, fat_areas_wgs, homepass_groups, gdf_wgs):
+    """Tulis KML (folder FAT AREA & HOMEPASS) langsung ke stream teks tanpa object tree.
+    
+    homepass_groups memetakan label FAT ke posisi baris HP di gdf_wgs.
+    """
+    out.write(KML_HEADER)
+    
+    # Folder FAT AREA (hanya yang ada HP-nya)
+    if len(fat_areas_wgs) > 0:
+        out.write('<Folder><name>FAT AREA</name>\n')
+        geometries = kml_polygons(fat_areas_wgs.geometry.values)
+        rows = zip(
+            fat_areas_wgs['label'].tolist(),
+            fat_areas_wgs['homepass'].tolist(),
+            fat_areas_wgs['color'].tolist(),
+            geometries
+        )
+        for label, homepass, color, geometry in rows:
+            out.write(
+                f'<Placemark><name>{escape(label)}</name>'
+                f'<description>Jumlah HP: {homepass}</description>'
+                f'<styleUrl>#fat-{color}</styleUrl>'
+                f'{geometry}</Placemark>\n'
+            )
+        out.write('</Folder>\n')
+    
+    # Folder HOMEPASS (hanya untuk FAT area yang ada)
+    if len(homepass_groups) > 0:
+        out.write('<Folder><name>HOMEPASS</name>\n')
+        # Koordinat WGS84 semua HP diambil sekali, lalu dipotong per FAT berdasarkan posisi baris
+        xy = shapely.get_coordinates(gdf_wgs.geometry.values)
+        for fat_name, positions in homepass_groups.items():
+            name = escape(fat_name)
+            out.write(f'<Folder><name>{name}</name>\n')
             
-            if not added:
-                # Buat FAT area baru untuk grid ini
-                fat_areas.append({
-                    'geometry': row['geometry'],
-                    'homepass': row['homepass'],
-                    'label': f'FAT {fat_index}',
-                    'color': 'red'  # Warna merah karena <16 HP
-                })
-                
-                points_in_grid = gdf[gdf.geometry.within(row['geometry'])]
-                homepass_groups[f'FAT {fat_index}'] = points_in_grid
-                fat_index += 1
-    
-    return gpd.GeoDataFrame(fat_areas, crs=grid_with_hp.crs), homepass_groups
+            # Semua HP satu FAT digabung dalam satu Placemark MultiGeometry
+            coords = xy[positions].tolist()
+            points_kml = ''.join(f'<Point><coordinates>{x},{y},0</coordinates></Point>' for x, y in coords)
+            out.write(
+                f'<Placemark><name>HP-{name}</name>'
+                f'<MultiGeometry>{points_kml}</MultiGeometry></Placemark>\n'
+            )
+            out.write('</Folder>\n')
+        out.write('</Folder>\n')
+    
+    out.write(KML_FOOTER)
 
 # UI
 uploaded_file = st.file_uploader("📤 Upload file KML berisi titik Homepass", type=["kml"])
 
 if uploaded_file:
-    gdf = load_kml(uploaded_file)
+    file_bytes = uploaded_file.getvalue()
+    gdf_wgs = load_kml(file_bytes)
     
-    if gdf is None or len(gdf) == 0:
+    if gdf_wgs is None or len(gdf_wgs) == 0:
         st.error("❌ Tidak ada data titik yang valid dalam file KML")
         st.stop()
     
-    st.success(f"✅ Berhasil memuat {len(gdf)} titik Homepass")
-    
-    # Konversi ke UTM
-    gdf = gdf.to_crs(epsg=32748)
-    
-    # Buat grid yang teratur
-    grid = create_aligned_grids(gdf)
+    st.success(f"✅ Berhasil memuat {len(gdf_wgs)} titik Homepass")
     
-    # Hitung titik per grid
-    joined = gpd.sjoin(grid, gdf, how='left', predicate='contains')
-    counts = joined.groupby(joined.index).size()
-    grid['homepass'] = counts.reindex(grid.index, fill_value=0).astype(int)
-    
-    # Filter hanya grid dengan HP
-    grid_with_hp = grid[grid['homepass'] > 0].copy()
+    # Proyeksi, grid & hitung HP per sel (di-cache per isi file)
+    gdf, grid_with_hp = build_grid(file_bytes)
     
     if len(grid_with_hp) == 0:
         st.error("❌ Tidak ada titik Homepass yang masuk dalam grid manapun")
@@ -125,44 +271,25 @@ if uploaded_file:
     
     # Buat FAT area hanya untuk grid dengan HP
     fat_areas, homepass_groups = create_fat_areas(grid_with_hp, gdf)
-    fat_areas_wgs = fat_areas.to_crs(epsg=4326)
-    
-    # Buat KML dengan struktur folder
-    kml = simplekml.Kml()
     
-    # Folder FAT AREA (hanya yang ada HP-nya)
-    if len(fat_areas) > 0:
-        fat_folder = kml.newfolder(name="FAT AREA")
-        for _, row in fat_areas_wgs.iterrows():
-            poly = fat_folder.newpolygon(name=row['label'])
-            poly.style.polystyle.color = simplekml.Color.green if row['color'] == 'green' else simplekml.Color.red
-            poly.style.linestyle.color = simplekml.Color.green if row['color'] == 'green' else simplekml.Color.red
-            poly.style.linestyle.width = 2
-            
-            if hasattr(row.geometry, 'geoms'):
-                for geom in row.geometry.geoms:
-                    poly.outerboundaryis = [(x,y) for x,y in geom.exterior.coords]
-            else:
-                poly.outerboundaryis = [(x,y) for x,y in row.geometry.exterior.coords]
-            
-            poly.description = f"Jumlah HP: {row['homepass']}"
+    # Reproyeksi hull FAT ke WGS84 dengan transformer yang di-cache
+    hulls_wgs = shapely.transform(
+        fat_areas.geometry.values,
+        lambda xy: np.column_stack(TO_WGS.transform(xy[:, 0], xy[:, 1]))
+    )
+    fat_areas_wgs = gpd.GeoDataFrame(fat_areas.drop(columns='geometry'), geometry=hulls_wgs, crs=4326)
     
-    # Folder HOMEPASS (hanya untuk FAT area yang ada)
-    if len(homepass_groups) > 0:
-        hp_folder = kml.newfolder(name="HOMEPASS")
-        for fat_name, points in homepass_groups.items():
-            fat_hp_folder = hp_folder.newfolder(name=fat_name)
-            points_wgs = points.to_crs(epsg=4326)
-            
-            for _, point in points_wgs.iterrows():
-                pnt = fat_hp_folder.newpoint(name=f"HP-{fat_name}")
-                pnt.coords = [(point.geometry.x, point.geometry.y)]
+    # Tulis KML dengan struktur folder langsung sebagai UTF-8 ke buffer biner,
+    # jadi KML tidak pernah disimpan utuh sebagai str lalu di-encode lagi
+    kml_buffer = BytesIO()
+    kml_text = TextIOWrapper(kml_buffer, encoding='utf-8')
+    write_kml(kml_text, fat_areas_wgs, homepass_groups, gdf_wgs)
+    kml_text.detach()
     
     # Download KML
-    kml_bytes = BytesIO(kml.kml().encode('utf-8'))
     st.download_button(
         "⬇️ Download KML dengan Struktur Folder",
-        kml_bytes.getvalue(),
+        kml_buffer.getvalue(),
         "fat_homepass_structured.kml",
         "application/vnd.google-earth.kml+xml"
     )
@@ -171,15 +298,14 @@ if uploaded_file:
     st.subheader("📊 Statistik FAT AREA")
     
     if len(fat_areas) > 0:
-        stats = []
-        for _, row in fat_areas.iterrows():
-            stats.append({
-                'FAT AREA': row['label'],
-                'Jumlah HP': row['homepass'],
-                'Status': 'Hijau (≥16 HP)' if row['color'] == 'green' else 'Merah (<16 HP)',
-                'Luas (m²)': round(row.geometry.area, 2)
-            })
+        # Susun tabel per kolom; status dipetakan sekaligus dengan np.where
+        stats = pd.DataFrame({
+            'FAT AREA': fat_areas['label'].to_numpy(),
+            'Jumlah HP': fat_areas['homepass'].to_numpy(),
+            'Status': np.where(fat_areas['color'].to_numpy() == 'green', 'Hijau (≥16 HP)', 'Merah (<16 HP)'),
+            'Luas (m²)': fat_areas.geometry.area.round(2).to_numpy()
+        })
         
-        st.dataframe(pd.DataFrame(stats))
+        st.dataframe(stats)
     else:
         st.info("Tidak ada FAT AREA yang teridentifikasi")